@@ -1,202 +1,69 @@
 #!/usr/bin/env python3
 """
-EPG to M3U Icons - Merge channel icons from EPG into M3U playlists
+EPG to M3U Icons - Flask entry point serving the merged playlist
 """
-import re
+import gzip
 import os
-import xml.etree.ElementTree as ET
+import threading
+from datetime import datetime
 from flask import Flask, Response, request, render_template_string, redirect, url_for
-import requests
-from urllib.parse import unquote
 from dotenv import load_dotenv
 
+from epgmerge.core import fetch_playlist_sources, iter_merged, parse_m3u
+
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 
-
-def fetch_url(url):
-    """Fetch content from a URL"""
-    try:
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        return response.text
-    except requests.RequestException as e:
-        raise Exception(f"Failed to fetch {url}: {str(e)}")
+# Responses smaller than this are not worth compressing
+_GZIP_MIN_SIZE = 1024
 
 
-def parse_epg(epg_content):
-    """Parse EPG/XMLTV and extract channel icons
+@app.after_request
+def _compress_response(response):
+    """Gzip buffered responses for clients that accept it
 
-    Returns:
-        dict: Mapping of channel ID to icon URL
+    A merged M3U is mostly repeated URL prefixes and compresses roughly
+    10:1. Streamed (direct passthrough) responses are left untouched.
     """
-    icon_map = {}
-
-    try:
-        root = ET.fromstring(epg_content)
-
-        # Find all channel elements
-        for channel in root.findall('.//channel'):
-            channel_id = channel.get('id')
-            if not channel_id:
-                continue
-
-            # Look for icon element
-            icon = channel.find('icon')
-            if icon is not None and icon.get('src'):
-                icon_map[channel_id.lower()] = icon.get('src')
-
-            # Also map display-name to icon for matching
-            for display_name in channel.findall('display-name'):
-                if display_name.text:
-                    icon_map[display_name.text.lower()] = icon.get('src') if icon is not None else None
-
-    except ET.ParseError as e:
-        raise Exception(f"Failed to parse EPG XML: {str(e)}")
-
-    return icon_map
-
-
-def parse_m3u(m3u_content):
-    """Parse M3U playlist into entries
-
-    Returns:
-        list: List of tuples (extinf_line, url_line)
-    """
-    lines = m3u_content.strip().split('\n')
-    entries = []
-
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-
-        if line.startswith('#EXTINF:'):
-            extinf_line = line
-            # Get the next non-empty, non-comment line as the URL
-            i += 1
-            while i < len(lines):
-                url_line = lines[i].strip()
-                if url_line and not url_line.startswith('#'):
-                    entries.append((extinf_line, url_line))
-                    break
-                elif url_line.startswith('#'):
-                    # Skip other comment lines
-                    i += 1
-                else:
-                    i += 1
-        i += 1
-
-    return entries
-
-
-def extract_channel_info(extinf_line):
-    """Extract channel information from EXTINF line
-
-    Returns:
-        dict: Channel info including tvg-id, tvg-name, group-title, and channel-name
-    """
-    info = {
-        'tvg-id': None,
-        'tvg-name': None,
-        'tvg-logo': None,
-        'group-title': None,
-        'channel-name': None
-    }
-
-    # Extract tvg-id
-    tvg_id_match = re.search(r'tvg-id="([^"]*)"', extinf_line)
-    if tvg_id_match:
-        info['tvg-id'] = tvg_id_match.group(1)
-
-    # Extract tvg-name
-    tvg_name_match = re.search(r'tvg-name="([^"]*)"', extinf_line)
-    if tvg_name_match:
-        info['tvg-name'] = tvg_name_match.group(1)
-
-    # Extract tvg-logo
-    tvg_logo_match = re.search(r'tvg-logo="([^"]*)"', extinf_line)
-    if tvg_logo_match:
-        info['tvg-logo'] = tvg_logo_match.group(1)
-
-    # Extract group-title
-    group_match = re.search(r'group-title="([^"]*)"', extinf_line)
-    if group_match:
-        info['group-title'] = group_match.group(1)
-
-    # Extract channel name (after the last comma)
-    name_match = re.search(r',(.+)$', extinf_line)
-    if name_match:
-        info['channel-name'] = name_match.group(1).strip()
-
-    return info
-
-
-def update_extinf_logo(extinf_line, new_logo_url):
-    """Update or add tvg-logo attribute in EXTINF line"""
-    # Check if tvg-logo already exists
-    if 'tvg-logo=' in extinf_line:
-        # Replace existing tvg-logo
-        return re.sub(r'tvg-logo="[^"]*"', f'tvg-logo="{new_logo_url}"', extinf_line)
-    else:
-        # Add tvg-logo after #EXTINF:
-        # Insert after the duration (e.g., #EXTINF:-1 or #EXTINF:0)
-        match = re.match(r'(#EXTINF:[^,\s]+\s*)(.*)', extinf_line)
-        if match:
-            return f'{match.group(1)}tvg-logo="{new_logo_url}" {match.group(2)}'
-        else:
-            # Fallback: just append before the comma
-            return extinf_line.replace(',', f' tvg-logo="{new_logo_url}",', 1)
-
-
-def merge_m3u_with_epg_icons(m3u_content, epg_content):
-    """Merge M3U playlist with icons from EPG
-
-    Returns:
-        str: Modified M3U content with updated icons
+    if (response.direct_passthrough
+            or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.content_length is None
+            or response.content_length < _GZIP_MIN_SIZE
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+
+    response.set_data(gzip.compress(response.get_data(), compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _warm_caches(m3u_url, epg_url):
+    """Pre-fetch and pre-parse the configured sources
+
+    Populates the fetch, icon-map and M3U parse caches so the first real
+    request after startup (or a settings change) is served warm instead
+    of paying full download and parse latency.
     """
-    # Parse EPG to get icon mapping
-    icon_map = parse_epg(epg_content)
-
-    # Parse M3U entries
-    entries = parse_m3u(m3u_content)
-
-    # Build new M3U content
-    result_lines = ['#EXTM3U']
-
-    matched_count = 0
-    total_count = len(entries)
-
-    for extinf_line, url_line in entries:
-        channel_info = extract_channel_info(extinf_line)
-
-        # Try to find icon using various matching strategies
-        new_logo = None
-
-        # Strategy 1: Match by tvg-id
-        if channel_info['tvg-id'] and channel_info['tvg-id'].lower() in icon_map:
-            new_logo = icon_map[channel_info['tvg-id'].lower()]
-
-        # Strategy 2: Match by tvg-name
-        if not new_logo and channel_info['tvg-name'] and channel_info['tvg-name'].lower() in icon_map:
-            new_logo = icon_map[channel_info['tvg-name'].lower()]
-
-        # Strategy 3: Match by channel-name
-        if not new_logo and channel_info['channel-name'] and channel_info['channel-name'].lower() in icon_map:
-            new_logo = icon_map[channel_info['channel-name'].lower()]
-
-        # Update logo if found
-        if new_logo:
-            extinf_line = update_extinf_logo(extinf_line, new_logo)
-            matched_count += 1
-
-        result_lines.append(extinf_line)
-        result_lines.append(url_line)
+    try:
+        print(f"Warming caches from {m3u_url} and {epg_url}")
+        m3u_content, _ = fetch_playlist_sources(m3u_url, epg_url)
+        parse_m3u(m3u_content)
+    except Exception as e:
+        # Warm-up is best-effort; the next request will just fetch cold
+        print(f"Cache warm-up failed: {str(e)}")
 
-    print(f"Matched {matched_count} out of {total_count} channels with EPG icons")
 
-    return '\n'.join(result_lines)
+def _start_warmup():
+    """Kick off cache warm-up in the background if URLs are configured"""
+    m3u_url = os.getenv('M3U_URL')
+    epg_url = os.getenv('EPG_URL')
+    if m3u_url and epg_url:
+        threading.Thread(target=_warm_caches, args=(m3u_url, epg_url),
+                         daemon=True).start()
 
 
 @app.route('/playlist.m3u')
@@ -212,20 +79,21 @@ def serve_playlist():
     if not epg_url:
         return "Error: 'epg' parameter is required or EPG_URL must be set in .env file", 400
 
+    # overwrite=0 preserves logos the playlist already has and only fills
+    # in missing ones
+    overwrite = request.args.get('overwrite', '1').lower() not in ('0', 'false', 'no')
+
     try:
-        # Fetch M3U and EPG
+        # Fetch M3U and EPG concurrently
         print(f"Fetching M3U from: {m3u_url}")
-        m3u_content = fetch_url(m3u_url)
-
         print(f"Fetching EPG from: {epg_url}")
-        epg_content = fetch_url(epg_url)
+        m3u_content, icon_map = fetch_playlist_sources(m3u_url, epg_url)
 
-        # Merge icons
+        # Merge icons, streaming the playlist to the client as entries
+        # are processed instead of building the whole string first
         print("Merging M3U with EPG icons...")
-        merged_content = merge_m3u_with_epg_icons(m3u_content, epg_content)
-
-        # Return as M3U file
-        return Response(merged_content, mimetype='application/x-mpegurl')
+        return Response(iter_merged(m3u_content, icon_map, overwrite=overwrite),
+                        mimetype='application/x-mpegurl')
 
     except Exception as e:
         return f"Error: {str(e)}", 500
@@ -366,14 +234,18 @@ def settings():
 
         with open(env_path, 'w') as f:
             f.write(f"# EPG to M3U Icons Configuration\n")
-            f.write(f"# Updated: {os.popen('date').read().strip() if os.name != 'nt' else 'Now'}\n\n")
+            f.write(f"# Updated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
             f.write(f"M3U_URL={m3u_url}\n")
             f.write(f"EPG_URL={epg_url}\n")
 
-        # Reload environment variables
-        load_dotenv(override=True)
+        # Apply directly - no need to re-parse the file we just wrote
+        os.environ['M3U_URL'] = m3u_url
+        os.environ['EPG_URL'] = epg_url
         success = True
 
+        # Warm the caches for the new URLs in the background
+        _start_warmup()
+
     # Get current values
     m3u_url = os.getenv('M3U_URL', '')
     epg_url = os.getenv('EPG_URL', '')
@@ -468,6 +340,7 @@ def index():
             <ul>
                 <li><strong>m3u</strong> - URL to your M3U playlist (optional if configured in settings)</li>
                 <li><strong>epg</strong> - URL to your EPG/XMLTV file (optional if configured in settings)</li>
+                <li><strong>overwrite</strong> - set to <code>0</code> to keep logos already in the playlist and only fill missing ones (default: overwrite)</li>
             </ul>
 
             <h3>Example:</h3>
@@ -480,9 +353,15 @@ def index():
     """
 
 
+# Warm the caches at import so the first request is fast under any server
+_start_warmup()
+
+
 if __name__ == '__main__':
-    # Run the server
+    # Run the server. The built-in server is threaded so a slow merge does
+    # not block other requests; for production use a WSGI server, e.g.
+    #   gunicorn -k gthread -w 2 --threads 8 -b 0.0.0.0:5000 app:app
     print("Starting EPG to M3U Icons server...")
     print("Server will be available at: http://localhost:5000")
     print("\nUsage: http://localhost:5000/playlist.m3u?m3u=<M3U_URL>&epg=<EPG_URL>")
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, threaded=True)
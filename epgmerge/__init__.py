@@ -0,0 +1,24 @@
+"""EPG to M3U Icons - merge channel icons from EPG into M3U playlists"""
+from .core import (
+    fetch_url,
+    fetch_epg_icon_map,
+    fetch_playlist_sources,
+    parse_epg,
+    parse_m3u,
+    extract_channel_info,
+    update_extinf_logo,
+    iter_merged,
+    merge_m3u_with_epg_icons,
+)
+
+__all__ = [
+    'fetch_url',
+    'fetch_epg_icon_map',
+    'fetch_playlist_sources',
+    'parse_epg',
+    'parse_m3u',
+    'extract_channel_info',
+    'update_extinf_logo',
+    'iter_merged',
+    'merge_m3u_with_epg_icons',
+]
@@ -0,0 +1,472 @@
+"""Core fetch/parse/merge logic for EPG to M3U icon merging"""
+import io
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+try:
+    # lxml (libxml2) parses XMLTV several times faster than the stdlib parser
+    from lxml import etree as ET
+    _XML_PARSE_ERROR = ET.XMLSyntaxError
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _XML_PARSE_ERROR = ET.ParseError
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared executor for fetching the M3U and EPG in parallel
+_FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Shared HTTP session - keep-alive amortizes TCP/TLS handshakes to the
+# upstream M3U/EPG hosts across requests
+_SESSION = requests.Session()
+_session_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                               max_retries=Retry(total=2, backoff_factor=0.2))
+_SESSION.mount('http://', _session_adapter)
+_SESSION.mount('https://', _session_adapter)
+
+# Precompiled EXTINF patterns (avoids per-call pattern cache lookups in the merge loop)
+_ATTR_RE = re.compile(r'(tvg-id|tvg-name|tvg-logo|group-title)="([^"]*)"')
+
+# One M3U entry: an #EXTINF line, any number of comment/blank lines, then
+# the first non-comment line as the stream URL
+_ENTRY_RE = re.compile(
+    r'^[ \t]*(#EXTINF:[^\n]*)\n'
+    r'(?:[ \t\r]*(?:#[^\n]*)?\n)*'
+    r'[ \t]*([^#\s][^\n]*)',
+    re.M)
+
+# Strips everything but letters and digits when normalizing channel names
+_NON_ALNUM_RE = re.compile(r'[^a-z0-9]')
+
+# Shortest normalized prefix accepted as a fuzzy match - avoids pairing
+# unrelated channels on one or two shared leading characters
+_MIN_PREFIX_MATCH = 4
+
+
+def _normalize_name(name: str) -> str:
+    """Normalize a channel name for fuzzy matching (lowercase alnum only)"""
+    return _NON_ALNUM_RE.sub('', name.lower())
+
+
+class _NameTrie:
+    """Character trie over normalized channel names
+
+    Supports longest-prefix lookup in O(len(query)), used as a fallback
+    when no exact tvg-id/tvg-name/channel-name match exists.
+    """
+
+    # Sentinel child key marking a value stored at a node; cannot collide
+    # with the single-character keys used for trie edges
+    _VALUE = ''
+
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, key: str, value) -> None:
+        node = self._root
+        for char in key:
+            node = node.setdefault(char, {})
+        node[self._VALUE] = value
+
+    def longest_prefix(self, query: str, min_length: int = _MIN_PREFIX_MATCH):
+        """Return the value of the longest inserted key that prefixes query
+
+        Prefixes shorter than min_length are ignored. Returns None when
+        nothing qualifies.
+        """
+        node = self._root
+        best = None
+        for depth, char in enumerate(query, start=1):
+            node = node.get(char)
+            if node is None:
+                break
+            if depth >= min_length and self._VALUE in node:
+                best = node[self._VALUE]
+        return best
+
+
+# Tries built from icon maps, keyed by id() with a strong reference to the
+# map so the id stays valid while cached
+_NAME_TRIE_CACHE = {}
+
+
+def _name_trie_for(icon_map):
+    """Build (or reuse) the normalized-name trie for an icon map"""
+    cached = _NAME_TRIE_CACHE.get(id(icon_map))
+    if cached is not None and cached[0] is icon_map:
+        return cached[1]
+
+    trie = _NameTrie()
+    for key, icon in icon_map.items():
+        if icon:
+            normalized = _normalize_name(key)
+            if normalized:
+                trie.insert(normalized, icon)
+
+    _parse_cache_put(_NAME_TRIE_CACHE, id(icon_map), (icon_map, trie))
+    return trie
+
+
+# Cache of fetched URLs: url -> (etag, last_modified, content)
+# Used for conditional GETs so unchanged upstreams are not re-downloaded
+_FETCH_CACHE = {}
+
+# Parsed-result caches keyed by content hash, so repeat requests with
+# unchanged upstreams skip XML/M3U parsing entirely
+_EPG_PARSE_CACHE = {}
+_M3U_PARSE_CACHE = {}
+_PARSE_CACHE_MAX = 4
+
+
+def _parse_cache_put(cache, key, value):
+    """Insert into a parse cache, evicting the oldest entry when full"""
+    if len(cache) >= _PARSE_CACHE_MAX:
+        cache.pop(next(iter(cache)))
+    cache[key] = value
+
+
+def fetch_url(url):
+    """Fetch content from a URL, revalidating a cached copy when possible"""
+    cached = _FETCH_CACHE.get(url)
+    headers = {}
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    try:
+        response = _SESSION.get(url, timeout=30, headers=headers)
+
+        # Upstream unchanged - reuse the cached body
+        if response.status_code == 304 and cached:
+            return cached[2]
+
+        response.raise_for_status()
+        content = response.text
+
+        # Only cache responses we can revalidate later
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            _FETCH_CACHE[url] = (etag, last_modified, content)
+        else:
+            _FETCH_CACHE.pop(url, None)
+
+        return content
+    except requests.RequestException as e:
+        raise Exception(f"Failed to fetch {url}: {str(e)}")
+
+
+# Streamed EPG results: url -> (etag, last_modified, icon_map)
+_EPG_ICON_CACHE = {}
+
+
+def fetch_epg_icon_map(url):
+    """Fetch an EPG URL and build its icon map while the body downloads
+
+    The response body is piped straight into the incremental XML parser,
+    so parsing overlaps with network I/O and the EPG is never held in
+    memory as one big string. The resulting icon map is cached against
+    the response's ETag/Last-Modified for conditional re-fetches.
+
+    Returns:
+        dict: Mapping of channel ID to icon URL
+    """
+    cached = _EPG_ICON_CACHE.get(url)
+    headers = {}
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    try:
+        response = _SESSION.get(url, timeout=30, headers=headers, stream=True)
+
+        # Upstream unchanged - reuse the already-parsed icon map
+        if response.status_code == 304 and cached:
+            response.close()
+            return cached[2]
+
+        response.raise_for_status()
+
+        # Let urllib3 decompress gzip transparently while we stream
+        response.raw.decode_content = True
+        icon_map = parse_epg(response.raw)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            _EPG_ICON_CACHE[url] = (etag, last_modified, icon_map)
+        else:
+            _EPG_ICON_CACHE.pop(url, None)
+
+        return icon_map
+    except requests.RequestException as e:
+        raise Exception(f"Failed to fetch {url}: {str(e)}")
+
+
+def fetch_playlist_sources(m3u_url, epg_url):
+    """Fetch the M3U body and the EPG icon map concurrently
+
+    Latency is max() of the two upstream round trips instead of their sum.
+
+    Returns:
+        tuple: (m3u_content, icon_map)
+    """
+    m3u_future = _FETCH_EXECUTOR.submit(fetch_url, m3u_url)
+    epg_future = _FETCH_EXECUTOR.submit(fetch_epg_icon_map, epg_url)
+    return m3u_future.result(), epg_future.result()
+
+
+def parse_epg(epg_content):
+    """Parse EPG/XMLTV and extract channel icons
+
+    Accepts a str, bytes, or binary file-like object. The XML is parsed
+    incrementally and each element is cleared once processed, so peak
+    memory stays at one channel instead of the whole EPG.
+
+    Returns:
+        dict: Mapping of channel ID to icon URL
+    """
+    # Memoize by content hash when the whole document is in memory
+    cache_key = None
+    if isinstance(epg_content, (str, bytes)):
+        cache_key = hash(epg_content)
+        if cache_key in _EPG_PARSE_CACHE:
+            return _EPG_PARSE_CACHE[cache_key]
+
+    icon_map = {}
+
+    if isinstance(epg_content, str):
+        source = io.BytesIO(epg_content.encode('utf-8'))
+    elif isinstance(epg_content, (bytes, bytearray)):
+        source = io.BytesIO(epg_content)
+    else:
+        source = epg_content
+
+    try:
+        for event, channel in ET.iterparse(source, events=('end',)):
+            if channel.tag == 'programme':
+                # Programme data is not needed for icons; free it immediately
+                channel.clear()
+                continue
+            if channel.tag != 'channel':
+                continue
+
+            channel_id = channel.get('id')
+            if not channel_id:
+                channel.clear()
+                continue
+
+            # Look for icon element. Keys are interned so merge-loop dict
+            # probes can short-circuit on pointer identity.
+            icon = channel.find('icon')
+            if icon is not None and icon.get('src'):
+                icon_map[sys.intern(channel_id.lower())] = icon.get('src')
+
+            # Also map display-name to icon for matching
+            for display_name in channel.findall('display-name'):
+                if display_name.text:
+                    icon_map[sys.intern(display_name.text.lower())] = icon.get('src') if icon is not None else None
+
+            channel.clear()
+
+    except _XML_PARSE_ERROR as e:
+        raise Exception(f"Failed to parse EPG XML: {str(e)}")
+
+    if cache_key is not None:
+        _parse_cache_put(_EPG_PARSE_CACHE, cache_key, icon_map)
+
+    return icon_map
+
+
+def parse_m3u(m3u_content: str) -> List[Tuple[str, str]]:
+    """Parse M3U playlist into entries
+
+    Returns:
+        list: List of tuples (extinf_line, url_line)
+    """
+    cache_key = hash(m3u_content)
+    if cache_key in _M3U_PARSE_CACHE:
+        return _M3U_PARSE_CACHE[cache_key]
+
+    # A single compiled regex over the whole blob keeps the scan in the
+    # C regex engine instead of a per-line Python loop
+    entries = [(m.group(1).rstrip(), m.group(2).rstrip())
+               for m in _ENTRY_RE.finditer(m3u_content)]
+
+    _parse_cache_put(_M3U_PARSE_CACHE, cache_key, entries)
+
+    return entries
+
+
+def _parse_extinf(extinf_line: str) -> Tuple[Dict[str, Optional[str]], Optional[Tuple[int, int]]]:
+    """Parse an EXTINF line into channel info plus the tvg-logo value span
+
+    The span lets the merge loop splice in a replacement logo directly
+    instead of re-scanning the line with a substitution regex.
+
+    Returns:
+        tuple: (info dict, (start, end) span of the tvg-logo value or None)
+    """
+    info = {
+        'tvg-id': None,
+        'tvg-name': None,
+        'tvg-logo': None,
+        'group-title': None,
+        'channel-name': None
+    }
+    logo_span = None
+
+    # Extract all quoted attributes in a single scan
+    last_end = 0
+    for match in _ATTR_RE.finditer(extinf_line):
+        info[match.group(1)] = match.group(2)
+        if match.group(1) == 'tvg-logo':
+            logo_span = match.span(2)
+        last_end = match.end()
+
+    # Extract channel name (after the comma that follows the last attribute,
+    # so commas inside quoted values are not mistaken for the separator)
+    comma = extinf_line.find(',', last_end)
+    if comma != -1 and comma < len(extinf_line) - 1:
+        info['channel-name'] = extinf_line[comma + 1:].strip()
+
+    return info, logo_span
+
+
+def extract_channel_info(extinf_line: str) -> Dict[str, Optional[str]]:
+    """Extract channel information from EXTINF line
+
+    Returns:
+        dict: Channel info including tvg-id, tvg-name, group-title, and channel-name
+    """
+    return _parse_extinf(extinf_line)[0]
+
+
+def update_extinf_logo(extinf_line: str, new_logo_url: str,
+                       logo_span: Optional[Tuple[int, int]] = None) -> str:
+    """Update or add tvg-logo attribute in EXTINF line
+
+    logo_span is the (start, end) span of the existing tvg-logo value as
+    reported by _parse_extinf; when known, the rewrite is a plain string
+    splice. All paths work with str.find/slicing - no regex.
+    """
+    # Locate the existing value if the caller has not already done so
+    if logo_span is None:
+        attr = extinf_line.find('tvg-logo="')
+        if attr != -1:
+            start = attr + len('tvg-logo="')
+            end = extinf_line.find('"', start)
+            if end != -1:
+                logo_span = (start, end)
+
+    # Replace existing tvg-logo by splicing over its value
+    if logo_span is not None:
+        start, end = logo_span
+        return extinf_line[:start] + new_logo_url + extinf_line[end:]
+
+    # Add tvg-logo after #EXTINF:
+    # Insert after the duration (e.g., #EXTINF:-1 or #EXTINF:0)
+    if extinf_line.startswith('#EXTINF:'):
+        pos = len('#EXTINF:')
+        length = len(extinf_line)
+        while pos < length and extinf_line[pos] not in ' \t,':
+            pos += 1
+        head = extinf_line[:pos]
+        rest = extinf_line[pos:].lstrip(' \t')
+        if rest.startswith(','):
+            return f'{head} tvg-logo="{new_logo_url}"{rest}'
+        return f'{head} tvg-logo="{new_logo_url}" {rest}'
+
+    # Fallback: just append before the comma
+    return extinf_line.replace(',', f' tvg-logo="{new_logo_url}",', 1)
+
+
+def iter_merged(m3u_content: str, icon_map: Dict[str, Optional[str]],
+                overwrite: bool = True):
+    """Merge an M3U playlist with EPG icons, one entry at a time
+
+    Generator variant of merge_m3u_with_epg_icons: bytes can start
+    flowing to the client while later entries are still being merged, and
+    the full output string is never materialized.
+
+    With overwrite=False, entries that already carry a tvg-logo are
+    passed through untouched (only missing logos are filled in), which
+    also skips their icon lookup and rewrite entirely.
+
+    Yields:
+        str: Chunks of the merged playlist, each ending in a newline
+    """
+    # Parse M3U entries
+    entries = parse_m3u(m3u_content)
+
+    yield '#EXTM3U\n'
+
+    matched_count = 0
+    total_count = len(entries)
+
+    # Bind hot globals/methods to locals - skips a global or attribute
+    # lookup per use inside the loop
+    parse_extinf = _parse_extinf
+    icon_get = icon_map.get
+    intern = sys.intern
+    name_trie = _name_trie_for(icon_map)
+
+    for extinf_line, url_line in entries:
+        channel_info, logo_span = parse_extinf(extinf_line)
+
+        # Entry already has a logo and we are only filling gaps - no
+        # lookup or rewrite needed
+        if not overwrite and channel_info['tvg-logo']:
+            yield f'{extinf_line}\n{url_line}\n'
+            continue
+
+        # Try to find icon by tvg-id, then tvg-name, then channel-name.
+        # Lowercase each key once and probe with .get() so every strategy
+        # costs a single dict lookup.
+        tvg_id = channel_info['tvg-id']
+        tvg_name = channel_info['tvg-name']
+        channel_name = channel_info['channel-name']
+
+        new_logo = None
+        if tvg_id:
+            new_logo = icon_get(intern(tvg_id.lower()))
+        if not new_logo and tvg_name:
+            new_logo = icon_get(intern(tvg_name.lower()))
+        if not new_logo and channel_name:
+            new_logo = icon_get(intern(channel_name.lower()))
+
+        # Strategy 4: fuzzy fallback - longest normalized-name prefix,
+        # which catches names differing only in punctuation/spacing/case
+        # or a trailing qualifier like "HD"
+        if not new_logo and channel_name:
+            normalized = _normalize_name(channel_name)
+            if normalized:
+                new_logo = name_trie.longest_prefix(normalized)
+
+        # Update logo if found, reusing the span located by the parser
+        if new_logo:
+            extinf_line = update_extinf_logo(extinf_line, new_logo, logo_span)
+            matched_count += 1
+
+        yield f'{extinf_line}\n{url_line}\n'
+
+    print(f"Matched {matched_count} out of {total_count} channels with EPG icons")
+
+
+def merge_m3u_with_epg_icons(m3u_content: str, icon_map: Dict[str, Optional[str]],
+                             overwrite: bool = True) -> str:
+    """Merge M3U playlist with icons from an EPG icon map
+
+    Returns:
+        str: Modified M3U content with updated icons
+    """
+    return ''.join(iter_merged(m3u_content, icon_map, overwrite=overwrite))